@@ -5,14 +5,48 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import datetime
-
-from scipy import integrate
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial, reduce
+
+from scipy import optimize
+from numba import njit, prange, set_num_threads, config as numba_config
 import seaborn as sns; sns.set()
+try:
+    # optional, only needed to run the solver on the GPU
+    import cupy
+except ImportError:
+    cupy = None
 
 ###------------------###
 ### Helper Functions ###
 ###------------------###
 
+## Data loading
+def cached_csv(url, cache_path, max_age_s=3600):
+    '''
+    Returns the dataframe of the csv at `url`. The parsed dataframe is kept in `cache_path`, and if it is
+    younger than `max_age_s` seconds it is read from there instead of downloading the csv again.
+    If the download fails, an older cached copy is used when there is one.
+    '''
+    if os.path.exists(cache_path) and time.time() - os.path.getmtime(cache_path) < max_age_s:
+        return pd.read_pickle(cache_path)
+
+    try:
+        df = pd.read_csv(url)
+    except OSError as error:
+        if not os.path.exists(cache_path):
+            raise
+        print('Could not download {} ({}), using the cached copy in {}'.format(url, error, cache_path))
+        return pd.read_pickle(cache_path)
+
+    if os.path.dirname(cache_path):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    df.to_pickle(cache_path)
+    return df
+
 ## Time series management
 def statal_timeseries(df, log=False):
     '''
@@ -34,13 +68,34 @@ def national_timeseries(df, log=False):
     else:
         return df.set_index('Fecha').loc[:,['México']]
 
+def parse_date(date):
+    '''
+    Returns the datetime of `date`, given either in our format (2020-03-19) or in the John Hopkins format (3/19/20).
+    The format is told apart by its characters instead of trying to parse both.
+    '''
+    fmt = '%Y-%m-%d' if date[4:5] == '-' else '%m/%d/%y'
+    return datetime.datetime.strptime(date, fmt)
+
+# formatted date ranges, keyed by (t0, n_days, fmt)
+_DATE_CACHE = {}
+
+def date_range(t0, n_days, fmt='%Y-%m-%d'):
+    '''
+    Returns the list of `n_days` consecutive dates starting at the datetime `t0`, formatted with `fmt`.
+    The ranges are cached, since the same one is requested for every scenario and every plot.
+    '''
+    key = (t0, n_days, fmt)
+    if key not in _DATE_CACHE:
+        _DATE_CACHE[key] = pd.date_range(t0, periods=n_days, freq='D').strftime(fmt).tolist()
+    return _DATE_CACHE[key]
+
 ### PLOTTING HELPERS
-def plot_cases(projection, dataset, state, initial_date, ls='-', label_proj='projection', label_data=''):
+def plot_cases(projection, dataset, state, initial_date, ls='-', label_proj='projection', label_data='', print_=True):
 
     # the index of the data df is the date.
     t0 = datetime.datetime.strptime( initial_date, '%Y-%m-%d')
     # construct time array
-    t_range = [(t0 + datetime.timedelta(days=x)).strftime('%d-%m') for x in range( projection.shape[0] )]
+    t_range = date_range(t0, projection.shape[0], '%d-%m')
 
     if state != 'México':
         data       = statal_timeseries(dataset, log=False).loc[initial_date:,state]
@@ -55,27 +110,32 @@ def plot_cases(projection, dataset, state, initial_date, ls='-', label_proj='pro
     # plt.yscale('log')
 
     mae = MAE(data, projection)
-    print('MAE: {}'.format(mae))
+    if print_:
+        print('MAE: {}'.format(mae))
     return mae
 
 # mean absolute error
 def MAE(x,y): return np.mean(np.abs( x[:] - y[:len(x)] ))
 
 ### Solution helper functions
+# index of each compartment in the model state
+IDX_S, IDX_E, IDX_CH, IDX_A, IDX_I, IDX_H, IDX_R, IDX_D = range(8)
 ## Time series management
-def Suceptibles(sol): return sol[:,0]
-def Exposed(sol): return sol[:,1]
-def Quarantined(sol): return sol[:,2]
-def Asymptomatic(sol): return sol[:,3]
-def Infected(sol): return sol[:,4]
-def Hospitalized(sol): return sol[:,5]
-def Recovered(sol): return sol[:,6]
-def Deceased(sol): return sol[:,7]
-def ActiveCases(sol): return Infected(sol) + Hospitalized(sol)
-def TotalCases(sol): return Infected(sol) + Hospitalized(sol) + Recovered(sol) + Deceased(sol)
-def ICUcases(sol): return Hospitalized(sol) + Deceased(sol)
+# The solutions are arrays of shape (..., 8, n_states): the compartments are on the second to last axis
+# and the states on the last one.
+def Suceptibles(sol): return sol[...,IDX_S,:]
+def Exposed(sol): return sol[...,IDX_E,:]
+def Quarantined(sol): return sol[...,IDX_CH,:]
+def Asymptomatic(sol): return sol[...,IDX_A,:]
+def Infected(sol): return sol[...,IDX_I,:]
+def Hospitalized(sol): return sol[...,IDX_H,:]
+def Recovered(sol): return sol[...,IDX_R,:]
+def Deceased(sol): return sol[...,IDX_D,:]
+def ActiveCases(sol): return sol[...,[IDX_I,IDX_H],:].sum(axis=-2)
+def TotalCases(sol): return sol[...,[IDX_I,IDX_H,IDX_R,IDX_D],:].sum(axis=-2)
+def ICUcases(sol): return sol[...,[IDX_H,IDX_D],:].sum(axis=-2)
 ## Aggregation
-def CasesAggregation(sol_per_state, f=TotalCases): return np.sum( [f(sol) for sol in sol_per_state], axis=0   )
+def CasesAggregation(sol, f=TotalCases): return f(sol).sum(axis=-1)
 
 # takes a set of solutions, aggregates them and saves them in a csv
 def scenario_to_csv(filename, sol, initial_date):
@@ -83,16 +143,10 @@ def scenario_to_csv(filename, sol, initial_date):
     Saves a return a single model output for a given scenario `sol` in a csv
     that contains the dynamics of each compartiment in each column.
     '''
-    try:
-        # our format
-        t0 = datetime.datetime.strptime(initial_date, '%Y-%m-%d')
-    except:
-        # John Hopkins format
-        t0 = datetime.datetime.strptime(initial_date, '%m/%d/%y')
-
-    # this is thought of as a list of arrays
-#     (t0 + datetime.timedelta(days=x)).strftime('%d-%m')
-    t_range = [t0 + datetime.timedelta(days=x) for x in range( sol[0].shape[0] )]
+    t0 = parse_date(initial_date)
+
+    # sol is an array of shape (n_days, 8, n_states)
+    t_range = pd.date_range(t0, periods=sol.shape[0], freq='D')
     CSV = pd.DataFrame(columns=['Fecha','Totales','Recuperados','Muertes','Hospitalizados'])
 
     CSV['Totales'] = CasesAggregation(sol, f=TotalCases)
@@ -110,27 +164,19 @@ def scenarios_to_csv(filename, dataset, scenarios, initial_date, f=TotalCases, R
     '''
     Saves and returns a csv file where the first column 'Totales' presents the available COVID-19 data in
     Mexico to date. The remaining columns are the fits+projections obtained with the model under different
-    containtment scenarios.
+    containtment scenarios. `scenarios` is an array of shape (n_scenarios, n_days, 8, n_states).
     '''
-    try:
-        # our format
-        t0 = datetime.datetime.strptime(initial_date, '%Y-%m-%d')
-    except:
-        # John Hopkins format
-        t0 = datetime.datetime.strptime(initial_date, '%m/%d/%y')
+    t0 = parse_date(initial_date)
 
-    # this is thought of as a list of arrays
-    #     (t0 + datetime.timedelta(days=x)).strftime('%d-%m')
-    t_range = [(t0 + datetime.timedelta(days=x)).strftime('%Y-%m-%d') for x in range( scenarios[0][0].shape[0] )]
+    t_range = date_range(t0, scenarios.shape[1])
+    # national cases of every scenario
+    national = CasesAggregation(scenarios, f=f).round().astype(np.int64)
 
-
-    CSV = pd.DataFrame(columns=['Fecha','Susana_00{}'.format(R0_index),'Susana_20{}'.format(R0_index),'Susana_50{}'.format(R0_index)])
-
-    CSV['Fecha'] = t_range
-    CSV.set_index('Fecha', inplace=True)
-    CSV.loc[t_range, 'Susana_00{}'.format(R0_index)] = CasesAggregation(scenarios[0], f=f).round().astype('int')
-    CSV.loc[t_range, 'Susana_20{}'.format(R0_index)] = CasesAggregation(scenarios[1], f=f).round().astype('int')
-    CSV.loc[t_range, 'Susana_50{}'.format(R0_index)] = CasesAggregation(scenarios[2], f=f).round().astype('int')
+    # nullable integers, so the columns stay integer when they are outer joined with the data
+    CSV = pd.DataFrame({'Susana_00{}'.format(R0_index): pd.array(national[0], dtype='Int64'),
+                        'Susana_20{}'.format(R0_index): pd.array(national[1], dtype='Int64'),
+                        'Susana_50{}'.format(R0_index): pd.array(national[2], dtype='Int64')},
+                       index=pd.Index(t_range, name='Fecha'))
 
     # Data = national_timeseries(dataset)
     # Data['México'] = Data['México'].astype(int)
@@ -142,310 +188,517 @@ def scenarios_to_csv(filename, dataset, scenarios, initial_date, f=TotalCases, R
 
     return CSV
 
-### DIRTY FITTING FUNCTIONS ###
-def solve_national(r, κ0, print_=False):
+### Initial conditions ###
+def initial_conditions(confirmed, deaths, recovered, N, r, p=1/2):
     '''
-    Return the aggregate cases of COVID-19 using our model using a containtment scenario κ0, and a proportion
-    `r` of latent infected people.
-    This functions assumes that `tc`, `projection_horizon`, `n_days`, `states_mex`,
-    and `population_per_state_mex` are already defined in the script.
+    Returns the initial distribution of every state as the columns of an array of shape (8, n_states).
+    `confirmed`, `deaths`, `recovered` and the population `N` are vectors with one entry per state, `r` is
+    the fraction of latent cases with respect to the confirmed cases (E0 + A0 = r * I0), and `p` splits
+    the latent cases into exposed and asymptomatic.
+    The inputs are broadcast against each other, so e.g. passing column vectors of cases and a vector of `r`
+    values returns an array of shape (8, n_states, n_r).
     '''
+    R0 = recovered / N              # fraction of recovered
+    D0 = deaths / N                 # fraction of deceased
+    I0 = ((confirmed/N) - R0 - D0)  # fraction of confirmed infected cases
+    E0 = p*r * I0                   # fraction of exposed non-infectious cases. Latent variable
+    A0 = (1-p)*r * I0               # fraction of asymptomatic but infectious cases. Latent variable
+    H0 = np.zeros_like(I0)          # fraction of hospitalized cases. No data yet
+    CH0 = np.zeros_like(I0)         # fraction of self-isolated cases. 0 if no prevention is made by the government
+    S0 = (1 - E0 - A0 - I0 - R0 - D0 - H0) # fraction of suceptible cases
 
-    ## Preallocation ##
-    # Vectors of solutions. Each vector will contain the results for each state for a specific containtment scenario
-    projections_κ0 = []
-
-    for (i, state) in enumerate(states_mex):
-        # population for state_i
-        N = population_per_state_mex[i]
-
-        # cases for state_i (from data)
-        confirmed = statal_timeseries(mex_confirmed).loc[initial_date, state]
-        deaths = statal_timeseries(mex_deaths).loc[initial_date, state]
-        recovered = statal_timeseries(mex_recovered).loc[initial_date, state]
+    return np.stack(np.broadcast_arrays(S0, E0, CH0, A0, I0, H0, R0, D0))
 
+### DIRTY FITTING FUNCTIONS ###
+def solve_national(r, κ0, β, cases_0, n_steps=None, out=None, print_=False):
+    '''
+    Return the aggregate cases of COVID-19 using our model using a containtment scenario κ0, an infectivity β, and a proportion
+    `r` of latent infected people. `cases_0` = (confirmed, deaths, recovered) are the vectors of cases per state at the initial date.
+    The model is run for `n_steps` days (`n_days` by default). `out` is an optional buffer for the solution, see `solve`.
+    This functions assumes that the model setup (`tc`, `n_days`, `states_mex`, `population_per_state_mex`, ...)
+    is already defined in the script.
+    '''
 
-        ## initial conditions of state_i setup ##
-        p = 1/2
-        R0 = recovered / N              # fraction of recovered
-        D0 = deaths / N                 # fraction of deceased
-        I0 = ((confirmed/N) - R0 - D0)  # fraction of confirmed infected cases
-        E0 = p*r * I0                 # fraction of exposed non-infectious cases. Latent variable
-        A0 = (1-p)*r * I0                 # fraction of asymptomatic but infectious cases. Latent variable
-        H0 = 0                          # fraction of hospitalized cases. No data yet
-        CH0 = 0                         # fraction of self-isolated cases. 0 if no prevention is made by the government
-        S0 = (1 - E0 - A0 - I0 - R0 - D0 - H0) # fraction of suceptible cases
-
-        # inital conditions of state_i
-        x0 = np.array([S0, E0, CH0, A0, I0, H0, R0, D0])
-
-        ### MODEL SIMULATIONS FOR VARIOUS CONTAINTMENT SCENARIOS ###
-        ## Parameters ###
-        params = (β, k_avg, η, α, γI, μI, ν, γH, μH, κ0, σ, tc)
+    # inital conditions of all states
+    x0 = initial_conditions(*cases_0, population_per_state_mex, r)
 
-        ### run models for state_i ###
-        projection_state_i = solve(SEAIHRD_markov_step, x0, 0.0, n_days, *params) * N
+    if print_:
+        log = pd.DataFrame({'state': states_mex, 'population': population_per_state_mex,
+                            'initial cases': TotalCases(x0) * population_per_state_mex})
+        print(log.to_string(index=False))
 
-        if print_:
-            print('{} has a population of {} people'.format(state, N))
-            print('with', (I0 + R0 + D0 + H0)*N, 'total cases.' )
+    ### MODEL SIMULATIONS FOR VARIOUS CONTAINTMENT SCENARIOS ###
+    ## Parameters ###
+    params = (β, k_avg, η, α, γI, μI, ν, γH, μH, np.array([κ0]), σ, tc)
 
-        # Join model simulation for state_i in the vector of solutions
-        projections_κ0.append( projection_state_i )
+    ### run models for all states at once ###
+    projections_κ0 = solve(x0, n_days if n_steps is None else n_steps, *params, out=out)[0] * population_per_state_mex
 
     # Return the total cases at a national level
     return CasesAggregation( projections_κ0 , f=TotalCases)
 
 # r minimization helper functions
-def f(r): return solve_national(r, 0.0, print_=False)
-def cross_validation(data, r_range): return [MAE(data, f(r)) for r in r_range]
-def r_min(r_range, mae_range): return r_range[mae_range.index(min(mae_range))]
+def f(r, β, cases_0, n_steps=None, out=None): return solve_national(r, 0.0, β, cases_0, n_steps, out=out, print_=False)
+def cross_validation(data, r_range, β, cases_0):
+    '''
+    Returns the MAE between `data` and the national cases without containtment for every proportion `r` in `r_range`.
+    The initial conditions for every value of r are stacked as extra columns, so all of them are integrated in a
+    single solve. Makes the same assumptions as `solve_national`.
+    '''
+    N = population_per_state_mex[:,None]
+
+    # inital conditions of all states for every r, with shape (8, n_states, n_r)
+    x0 = initial_conditions(*[cases[:,None] for cases in cases_0], N, r_range[None,:])
+
+    params = (β, k_avg, η, α, γI, μI, ν, γH, μH, np.array([0.0]), σ, tc)
+    sol = solve(x0.reshape(8, -1), len(data), *params)[0]
+
+    # national cases for every r, with shape (n_days, n_r)
+    projections = ( TotalCases(sol).reshape(len(data), *x0.shape[1:]) * N ).sum(axis=1)
+    return np.abs( projections - data[:,None] ).mean(axis=0)
+def r_min(r_range, mae_range): return r_range[np.argmin(mae_range)]
 
 
 ###------------------###
 ### Model Definition ###
 ###------------------###
 
-## Model helper functions
-# number of contacts
-def k(t, k_avg, κ0, σ, tc): return (1 - κ0*Θ(t,tc))*k_avg + κ0*(σ - 1)*Θ(t,tc)
-# probability of not getting infected
-def P(I,A, t, β, k_avg, κ0, σ, tc): return 1 - (1-β)**( k(t, k_avg, κ0, σ, tc)*(I+A) )
-# heaviside function
-def Θ(t,tc): return np.heaviside( t-tc, 1 )
-# kronecker delta
-def δ(t,tc):
-    if t == tc:
-        return 1
-    else:
-        return 0
+# floating point type of the model state. The fractions live in [0,1] and the results are rounded to
+# whole cases, so single precision is enough and halves the memory traffic of the solver
+DTYPE = np.float32
+# run the solver on the GPU with cupy. Worth it for large sweeps (long horizons, many scenarios or many values of r)
+USE_GPU = False
 
 ### Non-compartamental ###
     ## Discrete time Markovian model ##
-def SEAIHRD_markov_step(x, t, S_tc, CH_tc, *params):
+@njit(fastmath=True, cache=True)
+def SEAIHRD_markov_step(x, x_next, k_t, κ_tc, CH_next, log1mβ, η, α, γI, μI, ν, γH, μH):
     '''
     Suceptible (S), Exposed (E), Asymptomatic (A), Infected (I), Hospitalized (H), Recovered (R), Deceased (D) epidemic model.
-    The function takes a single time step in the units of days.
+    The function takes a single time step in the units of days from the distribution `x` of a state and writes it in `x_next`.
+
+    `k_t` is the number of contacts at this time step, `κ_tc` is the fraction of suceptibles that go into
+    confinement at this time step (κ0*CH_tc on the day of the containtment and 0 otherwise), and `CH_next` is the
+    fraction of confined households. `log1mβ` = log(1 - β) is precomputed by the solver.
+    '''
+    S,E,CH,A,I,H,R,D = x[0], x[1], x[2], x[3], x[4], x[5], x[6], x[7]
+    # an integer 1 would promote the arithmetic to double precision
+    one = DTYPE(1)
+
+    # probability of getting infected, 1 - (1-β)**(k_t*(I+A)), with a single exponential
+    P = -math.expm1(k_t*(I + A)*log1mβ)
+
+    x_next[0] = S*(one - P) * (one - κ_tc)           # S(t+1)
+    x_next[1] = S*P * (one - κ_tc) + (one-η)*E       # E(t+1)
+    x_next[2] = CH_next                              # CH(t+1)
+    x_next[3] = η*E + (one-α)*A                      # A(t+1)
+    x_next[4] = α*A + (one - (γI+μI+ν))*I            # I(t+1)
+    x_next[5] = ν*I + (one - (γH+μH))*H              # H(t+1)
+    x_next[6] = γI*I + γH*H + R                      # R(t+1)
+    x_next[7] = μI*I + μH*H + D                      # D(t+1)
+
+### Solver ###
+@njit(parallel=True, fastmath=True, cache=True)
+def solve_njit(sol, x0, β, k_avg, η, α, γI, μI, ν, γH, μH, κ0, σ, tc):
+    '''
+    Maps the SEAIHRD markov chain with initial distribution `x0` in the units of days, and writes the solution in `sol`.
+
+    `x0` has shape (8, n_states): every column is the initial distribution of a state, and `κ0` is a vector
+    with the containtment of each scenario. The states do not interact, so they are advanced in parallel.
+    The scenarios only differ after the containtment, so the days before tc are computed once and shared.
+    `sol` is a preallocated C-contiguous array of shape (n_states, n_scenarios, n_steps, 8), so every state is
+    written in its own contiguous block and the threads do not share cache lines.
 
     When confinement is present, the model is no longer Markovian as the variables depend on the state of S_tc = S(tc) and CH_tc = CH(tc).
-    If tc = np.inf, then no confinement is made.
+    The containtment day `tc` is an integer number of days. If tc = np.inf, then no confinement is made.
     '''
+    n_states, n_scenarios, n_steps = sol.shape[0], sol.shape[1], sol.shape[2]
+    zero, one = DTYPE(0), DTYPE(1)
+
+    # the infectivity only enters the step through log(1 - β)
+    log1mβ = math.log1p(-β)
+    # number of steps taken before the containtment
+    n_pre = n_steps - 1 if tc >= n_steps - 1 else int(tc)
+
+    for s in prange(n_states):
+        x = sol[s,0]
+        x[0] = x0[:,s]
+
+        ## Phase 1: t < tc. No one is confined and all the scenarios are the same
+        for t in range(n_pre):
+            SEAIHRD_markov_step(x[t], x[t+1], k_avg, zero, zero, log1mβ, η, α, γI, μI, ν, γH, μH)
+        for j in range(1, n_scenarios):
+            sol[s,j,:n_pre+1] = x[:n_pre+1]
+
+        if n_pre < n_steps - 1:
+            for j in range(n_scenarios):
+                x = sol[s,j]
+                # number of contacts after the containtment
+                k_post = (one - κ0[j])*k_avg + κ0[j]*(σ - one)
+
+                ## t = tc. A fraction κ0*CH_tc of the suceptibles goes into confinement
+                S_tc = x[n_pre,0]
+                CH_tc = math.exp(σ*math.log(S_tc + x[n_pre,6]))
+                SEAIHRD_markov_step(x[n_pre], x[n_pre+1], k_post, κ0[j]*CH_tc, S_tc*κ0[j]*CH_tc, log1mβ, η, α, γI, μI, ν, γH, μH)
+
+                ## Phase 2: t > tc. The confined stay confined
+                for t in range(n_pre + 1, n_steps - 1):
+                    SEAIHRD_markov_step(x[t], x[t+1], k_post, zero, x[t,2], log1mβ, η, α, γI, μI, ν, γH, μH)
+
+@njit(parallel=True, fastmath=True, cache=True)
+def solve_no_containment(sol, x0, β, k_avg, η, α, γI, μI, ν, γH, μH):
+    '''
+    Specialization of `solve_njit` for the case without containtment (κ0 = 0, or tc beyond the last day), which is
+    the case of every run made to fit r. The confined households stay at zero, so there is no CH, S_tc or CH_tc
+    arithmetic and no phases, and the state is kept in registers between days. Only the first scenario of `sol` is written.
+    '''
+    n_states, n_steps = sol.shape[0], sol.shape[2]
+    zero, one = DTYPE(0), DTYPE(1)
+
+    # the number of contacts is constant, so the infection exponent only needs k_avg*log(1 - β)
+    k_log1mβ = k_avg*math.log1p(-β)
+
+    for s in prange(n_states):
+        x = sol[s,0]
+        x[0] = x0[:,s]
+        S,E,A,I,H,R,D = x0[0,s], x0[1,s], x0[3,s], x0[4,s], x0[5,s], x0[6,s], x0[7,s]
 
-    β, k_avg, η, α, γI, μI, ν, γH, μH, *containtment_params = params
-    κ0, σ, tc = containtment_params
+        for t in range(1, n_steps):
+            # probability of getting infected
+            P = -math.expm1(k_log1mβ*(I + A))
+
+            S,E,A,I,H,R,D = (S*(one - P),                   # S(t+1)
+                             S*P + (one-η)*E,               # E(t+1)
+                             η*E + (one-α)*A,               # A(t+1)
+                             α*A + (one - (γI+μI+ν))*I,     # I(t+1)
+                             ν*I + (one - (γH+μH))*H,       # H(t+1)
+                             γI*I + γH*H + R,               # R(t+1)
+                             μI*I + μH*H + D)               # D(t+1)
+
+            x[t,0], x[t,1], x[t,2], x[t,3] = S, E, zero, A
+            x[t,4], x[t,5], x[t,6], x[t,7] = I, H, R, D
+
+def solve(x0, n_steps, β, k_avg, η, α, γI, μI, ν, γH, μH, κ0, σ, tc, out=None, gpu=None):
+    '''
+    Maps the SEAIHRD markov chain with initial distribution `x0` for `n_steps` steps in the units of days and returns
+    the solution as an array of shape (n_scenarios, n_steps, 8, n_states). See `solve_njit` for the arguments.
+
+    The initial conditions and parameters are cast to DTYPE, so the whole integration stays in single precision.
+    `out` is an optional preallocated array of shape (n_states, n_scenarios, n_steps, 8) and type DTYPE, which is
+    reused to store the solution when the model is solved repeatedly. The returned array is a view of it.
+    Runs without containtment are dispatched to `solve_no_containment`.
+    If USE_GPU is set, the model is solved with `solve_array` on the GPU instead and `out` is not used. `gpu` overrides
+    USE_GPU for this call.
+    '''
+    use_gpu = USE_GPU if gpu is None else gpu
+    if use_gpu:
+        if cupy is None:
+            raise ImportError('USE_GPU requires cupy')
+        return solve_array(x0, n_steps, β, k_avg, η, α, γI, μI, ν, γH, μH, κ0, σ, tc, xp=cupy)
+
+    params = [DTYPE(param) for param in (β, k_avg, η, α, γI, μI, ν, γH, μH)]
+
+    x0 = np.ascontiguousarray(x0, dtype=DTYPE)
+    κ0 = np.ascontiguousarray(κ0, dtype=DTYPE)
+    shape = (x0.shape[1], κ0.shape[0], n_steps, 8)
+    if out is None:
+        out = np.empty( shape, dtype=DTYPE )
+    elif out.shape != shape or out.dtype != DTYPE or not out.flags.c_contiguous:
+        # the solvers take the number of steps from the buffer, so a buffer of another size would silently change the horizon
+        raise ValueError('out must be a C-contiguous {} array of shape {}, got {} of shape {}'.format(np.dtype(DTYPE), shape, out.dtype, out.shape))
+
+    if np.all(κ0 == 0) or tc >= n_steps - 1:
+        # without containtment all the scenarios are the same, so only the first one is integrated
+        solve_no_containment(out, x0, *params)
+        out[:,1:] = out[:,:1]
+    else:
+        solve_njit(out, x0, *params, κ0, DTYPE(σ), tc)
+    return out.transpose(1, 2, 3, 0)
+
+    ## Array version for the GPU ##
+def SEAIHRD_array_step(x, x_next, k_t, κ_tc, CH_next, log1mβ, η, α, γI, μI, ν, γH, μH, xp):
+    '''
+    Same as `SEAIHRD_markov_step`, but `x` and `x_next` are arrays of shape (8, ...) that hold every state and
+    scenario, and the step is taken with elementwise operations of the array module `xp` (numpy or cupy).
+    '''
     S,E,CH,A,I,H,R,D = x
 
-    return [S*(1 - P(I,A, t, β, k_avg, κ0, σ, tc)) * (1 - δ(t,tc)*κ0*CH_tc),     # S(t+1)
-            S*P(I,A, t, β, k_avg, κ0, σ, tc) * (1 - δ(t,tc)*κ0*CH_tc) + (1-η)*E, # E(t+1)
-            S_tc * κ0 * CH_tc * Θ(t,tc),                                         # CH(t+1)
-            η*E + (1-α)*A,                                                       # A(t+1)
-            α*A + (1 - (γI+μI+ν))*I,                                             # I(t+1)
-            ν*I + (1 - (γH+μH))*H,                                               # H(t+1)
-            γI*I + γH*H + R,                                                     # R(t+1)
-            μI*I + μH*H + D]                                                     # D(t+1)
+    # probability of getting infected, 1 - (1-β)**(k_t*(I+A)), with a single exponential
+    P = -xp.expm1(k_t*(I + A)*log1mβ)
 
-### Solver ###
-def solve(f, x0, t0, n_steps, *params):
+    x_next[0] = S*(1 - P) * (1 - κ_tc)           # S(t+1)
+    x_next[1] = S*P * (1 - κ_tc) + (1-η)*E       # E(t+1)
+    x_next[2] = CH_next                          # CH(t+1)
+    x_next[3] = η*E + (1-α)*A                    # A(t+1)
+    x_next[4] = α*A + (1 - (γI+μI+ν))*I          # I(t+1)
+    x_next[5] = ν*I + (1 - (γH+μH))*H            # H(t+1)
+    x_next[6] = γI*I + γH*H + R                  # R(t+1)
+    x_next[7] = μI*I + μH*H + D                  # D(t+1)
+
+def solve_array(x0, n_steps, β, k_avg, η, α, γI, μI, ν, γH, μH, κ0, σ, tc, xp=np):
+    '''
+    Same as `solve_njit`, but written with elementwise operations of the array module `xp`, so with xp = cupy the
+    model is solved on the GPU: every day is a handful of elementwise kernels over all the states and scenarios.
+    The solution is returned to the host as a numpy array of shape (n_scenarios, n_steps, 8, n_states).
+    The arguments are the same as for `solve`, and are cast to DTYPE in the same way.
+    '''
+    n_states, n_scenarios = x0.shape[1], len(κ0)
+    sol = xp.empty( (n_steps, 8, n_scenarios, n_states), dtype=DTYPE )
+    sol[0] = xp.asarray(x0, dtype=DTYPE)[:,None,:]
+    κ0 = xp.asarray(κ0, dtype=DTYPE)[:,None]
+    β, k_avg, η, α, γI, μI, ν, γH, μH, σ = [DTYPE(param) for param in (β, k_avg, η, α, γI, μI, ν, γH, μH, σ)]
+    # the infectivity only enters the step through log(1 - β)
+    params = (DTYPE(math.log1p(-β)), η, α, γI, μI, ν, γH, μH)
+
+    # number of contacts after the containtment, for every scenario
+    k_post = (1 - κ0)*k_avg + κ0*(σ - 1)
+    # number of steps taken before the containtment
+    n_pre = n_steps - 1 if tc >= n_steps - 1 else int(tc)
+
+    ## Phase 1: t < tc. No one is confined
+    for t in range(n_pre):
+        SEAIHRD_array_step(sol[t], sol[t+1], k_avg, 0, 0, *params, xp)
+
+    if n_pre < n_steps - 1:
+        ## t = tc. A fraction κ0*CH_tc of the suceptibles goes into confinement
+        S_tc = sol[n_pre,0]
+        CH_tc = (S_tc + sol[n_pre,6])**σ
+        SEAIHRD_array_step(sol[n_pre], sol[n_pre+1], k_post, κ0*CH_tc, S_tc*κ0*CH_tc, *params, xp)
+
+        ## Phase 2: t > tc. The confined stay confined
+        for t in range(n_pre + 1, n_steps - 1):
+            SEAIHRD_array_step(sol[t], sol[t+1], k_post, 0, sol[t,2], *params, xp)
+
+    sol = sol.transpose(2, 0, 1, 3)
+    return sol if xp is np else xp.asnumpy(sol)
+
+def check_solve_array(x0, n_steps, β, κ0, xp=np, rtol=1e-4, atol=1e-9):
     '''
-    Maps the markov chain defined by `f` with initial distribution `x0` at `t0` for `n_steps` steps.
+    Checks that `solve_array` with the array module `xp` agrees with the numba solvers up to single precision, for the
+    containtment scenarios `κ0` and for a run without containtment, so the array version can not drift from the model.
+    Raises an AssertionError otherwise. Uses the model parameters of the script.
     '''
-    xt = [xi for xi in x0]
-    sol = np.zeros( (n_steps, len(x0)) )
-    S_tc, CH_tc = 0, 0
+    for κ in (np.asarray(κ0), np.array([0.0])):
+        params = (β, k_avg, η, α, γI, μI, ν, γH, μH, κ, σ, tc)
+        np.testing.assert_allclose(solve_array(x0, n_steps, *params, xp=xp), solve(x0, n_steps, *params, gpu=False),
+                                   rtol=rtol, atol=atol, err_msg='solve_array does not match solve')
+
+###-------------###
+### Model Setup ###
+###-------------###
+
+### PARAMETER ESTIMATION ###
+# population distribution as of 2020ish
+N_mex = 128_569_304 # https://www.worldometers.info/world-population/mexico-population/ (2020-03-34)
+pop_dist_mex = np.array([55545770, 62567894, 9461864])/N_mex
+
+## Arenas params
+η = 1/2.34 # η^-1 + α^-1 = 1/5.2 # exposed latent rate
+ωg = 0.42 # fatality rate of ICU patients
+ψg = 1/7  # death rate
+χg = 1/10 # ICU discharge rate
+σ  = 3.7 # average household size in Mexico (different from Arenas)
+μg = np.array([1/1,1/3.2,1/3.2]) # escape (from Infected) rate by age group
+γg = np.array([0.002, 0.05, 0.36]) # fraction of cases requiring ICU by age group
+kg = np.array([11.8, 13.3, 6.6]) # average contacts per day by age group
+αg = np.array([1/5.06, 1/2.86, 1/2.86]) # asymptomatic infectious rate by age group
+
+## avering out the age groups with the pyramidal distribution of Mexico
+μ_avg = np.dot(μg, pop_dist_mex)
+γ_avg = np.dot(γg, pop_dist_mex)
+k_avg =  np.dot(kg, pop_dist_mex)
+α = np.dot(αg, pop_dist_mex)
+
+## SEAIHRD model params
+# the infectivity β depends on R_0, see `infectivity`
+γI = μ_avg*(1 - γ_avg)
+μI = 0
+ν = μ_avg*γ_avg
+μH = ωg*ψg
+γH = (1 - ωg)*χg
+
+# infectivity of the desease (per contact per day) for a basic reproductive ratio R_0
+def infectivity(R_0): return -np.exp( -R_0/(k_avg * (1/α + 1/μ_avg) ) ) + 1
+
+# initial date for the model
+initial_date = '2020-03-19' # -19 This is the date in which the trend becomes exponential
+
+# model projection setup
+tc = 6 # containtment intervention date (days since initial_date)
+projection_horizon = 60 # 6 days
+
+### INITIAL CONDITIONS PER STATE SETUP ###
+# population per state in Mexico, list of states and number of days to run the model for. Set by `setup_model`
+population_per_state_mex = None
+states_mex = None
+n_days = None
+
+def setup_model():
+    '''
+    Reads the population of every state and sets the number of days to run the model for, which depends on the date
+    of today. This is done when the script runs instead of on import, and has to be done in every worker process.
+    '''
+    global population_per_state_mex, states_mex, n_days
 
-    (β, k_avg, η, α, γI, μI, ν, γH, μH, κ0, σ, tc) = params
+    populations = pd.read_csv('./data/poblaciones_estados.csv', index_col=0).sort_index()
+    population_per_state_mex = populations['population'].values
+    states_mex = populations.index.values
+    n_days = (datetime.datetime.today() - datetime.datetime.strptime(initial_date, '%Y-%m-%d')).days + projection_horizon
 
-    t = t0
-    for (i,t) in enumerate( range(n_steps) ):
+def init_worker(n_threads):
+    '''
+    Initializer of the worker processes: sets up the model and limits the numba threads of the process to `n_threads`,
+    so that the workers together do not start more threads than the numba pool has.
+    '''
+    set_num_threads(n_threads)
+    setup_model()
+
+### DETERMINING BEST FIT ###
+r_bounds = (0, 2.5) # We've seen empirically that they are not very big
+implementation_date = '2020-03-28' # officialy, it was implemented on the 25th, but we assume it takes at least 3 days to start seeing the effects.
+# compare the fitted r against the (slow) linear scan over r
+DEBUG_SCAN = False
+# check on a short run that the array version of the solver, which is only used on the GPU, matches the numba solvers
+DEBUG_SOLVE_ARRAY = False
+
+### SAVING RESULTS ###
+PLOT_PATH = './media/'
+CSV_PATH  = './results/'
+save_ = True
+
+def run_for_R0(R0_item, mex_confirmed, CONF, cases_0):
+    '''
+    Fits r and runs the containtment scenarios for the basic reproductive ratio in `R0_item` = (R0_index, R_0).
+    Saves the national plot of the projections and returns a DataFrame with the projections of every scenario
+    for this R_0. `cases_0` = (confirmed, deaths, recovered) are the vectors of cases per state at the initial date.
+    '''
+    R0ix, R_0 = R0_item
+    print('Doing R_0 = {}'.format(R_0))
+    β = infectivity(R_0)
+
+    ### DETERMINING BEST FIT ###
+    # We determine r, the proportion of latent E+A individuals, by minimizing the MAE before the containtment. The functions are very dirty at their current states
+    data_before_containtment = national_timeseries(mex_confirmed).loc[initial_date:implementation_date, 'México'].values
+    # the MAE is unimodal in r, so a bounded Brent search needs far fewer model runs than a linear scan.
+    # The MAE only looks at the days with data, so the model is only run for those.
+    # All the runs share the same buffer for the solution, sized to the fitted window
+    n_fit = len(data_before_containtment)
+    out = np.empty( (len(states_mex), 1, n_fit, 8), dtype=DTYPE )
+    res = optimize.minimize_scalar(lambda r: MAE(data_before_containtment, f(r, β, cases_0, n_fit, out)), bounds=r_bounds, method='bounded', options={'xatol': 1e-3})
+    # Taking best fit
+    r = res.x
+
+    if DEBUG_SCAN:
+        # sanity check against the linear scan over r
+        r_range = np.linspace(*r_bounds, 50)
+        mae_range = cross_validation(data_before_containtment, r_range, β, cases_0)
+        print('R_0 = {}: r = {}, r (linear scan) = {}'.format(R_0, r, r_min(r_range, mae_range)))
+
+    ## initial conditions of all states setup ##
+    # r denotes the fraction of latent cases with respect to the confirmed cases. This is, E0 + A0 = r * I0
+    x0 = initial_conditions(*cases_0, population_per_state_mex, r)
+
+    ### MODEL SIMULATIONS FOR VARIOUS CONTAINTMENT SCENARIOS ###
+    ## Scenarios: no action, mild distancing and strong distancing
+    κ0 = np.array([0.0, 0.2, 0.5])
+    params = (β, k_avg, η, α, γI, μI, ν, γH, μH, κ0, σ, tc)
+
+    ### run models for all states and scenarios at once ###
+    # the projections have shape (n_scenarios, n_days, 8, n_states)
+    projections = solve(x0, n_days, *params) * population_per_state_mex
+    # total cases of each state for every scenario, with shape (n_scenarios, n_days, n_states)
+    total_cases = TotalCases(projections)
+
+    # total cases per state at the initial date
+    total_cases_0 = TotalCases(x0) * population_per_state_mex
+
+    # summary of every state
+    log_rows = []
+    for (i,state) in enumerate(states_mex):
+        data = CONF.loc[initial_date:,state]
+        projection = total_cases[0,:,i]
+        tf_data = data.index.values[-1]
+        log_rows.append( (state, population_per_state_mex[i], total_cases_0[i], tf_data, np.round(projection[-projection_horizon-1]), data.values[-1], round(MAE(data, projection), 1)) )
+    log = pd.DataFrame(log_rows, columns=['state', 'population', 'initial cases', 'date', 'projected cases', 'oficial cases', 'MAE'])
+
+    ### SAVING RESULTS ###
+    ## Plot the projections of the model at a national level showing each scenario
+    plt.figure( figsize=(10,8) )
+    national_cases = total_cases.sum(axis=-1)
+    mae = plot_cases(national_cases[0], mex_confirmed, 'México', initial_date, ls='-', label_proj='$0 \%$ Susana', print_=False)
+    plot_cases(national_cases[1], mex_confirmed, 'México', initial_date, ls='--', label_proj='$20 \%$ Susana', print_=False)
+    plot_cases(national_cases[2], mex_confirmed, 'México', initial_date, ls='-.', label_proj='$50 \%$ Susana', label_data='Casos Totales', print_=False)
+    plt.axvline([tc], c='black', alpha=0.8)
+    plt.title( 'Casos totales de COVID-19 en {}. (MAE = {}) '.format('México', round(mae,1) ) , size=16)
+    plt.ylabel('Número de infectados', size=15);
+    # plt.yscale('log')
+    plt.tight_layout()
 
-        if t == tc:
-            S,E,CH,A,I,H,R,D = xt
-            S_tc, CH_tc = S, (S + R)**σ
+    # the R_0 values run at the same time, so everything about this one is printed at once
+    print('Projections for R_0 = {} (r = {}, initial date {}, national MAE = {}):\n{}\n'.format(R_0, r, initial_date, round(mae,1), log.to_string(index=False)))
 
-        sol[i,:] = xt
+    # here I construct, for every scenario and every value of R0, a CSV with all the corresponding projections
+    df_ = scenarios_to_csv(None, mex_confirmed, projections, initial_date, f=TotalCases, R0_index=R0ix)
 
-        xt = f(xt, t, S_tc, CH_tc, *params)
-        t += 1
+    if save_:
+        today_date = datetime.datetime.today().strftime('%d-%m-%y')
+        plt.savefig( PLOT_PATH+'covid19_mex_proyecciones_{}_R0_{}.png'.format( today_date, str(R_0).replace('.','p')) )
+        # sol_to_csv(CSV_PATH+'covid19_mex_proyeccion_susana_00_{}.csv'.format( today_date ), projections[0], initial_date)
+        # sol_to_csv(CSV_PATH+'covid19_mex_proyeccion_susana_20_{}.csv'.format( today_date ), projections[1], initial_date)
+        # sol_to_csv(CSV_PATH+'covid19_mex_proyeccion_susana_50_{}.csv'.format( today_date ), projections[2], initial_date)
+        print( 'Saved the plot for R_0 = {} in covid19_mex_proyecciones_{}_R0_{}.png'.format( R_0, today_date, str(R_0).replace('.','p') ) )
+    plt.close()
 
-    return sol
+    return df_
 
 if __name__ == "__main__":
 
+    setup_model()
+
     ## READING DATA ##
     # ElLeo data: mexican states
     DATA_URL_MEX = 'https://raw.githubusercontent.com/mexicovid19/Mexico-datos/master/datos/series_de_tiempo/'
+    # local copies of the parsed data, refreshed every hour
+    DATA_CACHE_PATH = './data/cache/'
 
-    mex_confirmed = pd.read_csv(DATA_URL_MEX+'covid19_mex_casos_totales.csv', )
-    mex_deaths = pd.read_csv(DATA_URL_MEX+'covid19_mex_muertes.csv', )
-    mex_recovered = pd.read_csv(DATA_URL_MEX+'covid19_mex_recuperados.csv', )
+    mex_confirmed = cached_csv(DATA_URL_MEX+'covid19_mex_casos_totales.csv', DATA_CACHE_PATH+'covid19_mex_casos_totales.pkl')
+    mex_deaths = cached_csv(DATA_URL_MEX+'covid19_mex_muertes.csv', DATA_CACHE_PATH+'covid19_mex_muertes.pkl')
+    mex_recovered = cached_csv(DATA_URL_MEX+'covid19_mex_recuperados.csv', DATA_CACHE_PATH+'covid19_mex_recuperados.pkl')
 
-    # preallocation of the CSV with the results of the model
-    CSV = pd.DataFrame()
+    # statal time series, computed only once
+    CONF = statal_timeseries(mex_confirmed)
+    DEATH = statal_timeseries(mex_deaths)
+    REC = statal_timeseries(mex_recovered)
 
-    ### PARAMETER ESTIMATION ###
-    # population distribution as of 2020ish
-    N_mex = 128_569_304 # https://www.worldometers.info/world-population/mexico-population/ (2020-03-34)
-    pop_dist_mex = np.array([55545770, 62567894, 9461864])/N_mex
+    # cases per state at the initial date (from data)
+    cases_0 = tuple( df.loc[initial_date, states_mex].to_numpy() for df in (CONF, DEATH, REC) )
 
     # Basic reproductive ratio
     # R_0s : 2.3, 95%-CI : (1.4, 3.9), according to Qun Li et al. 'Early Transmission Dynamics in Wuhan, China, ...'
     # ToDo: Do the R_0 thing automatically
     R0s = {'': 2.3, '_min': 1.4, '_max': 3.9}
-    for R0ix in R0s:
-        R_0 = R0s[R0ix]
-        print('Doing R_0 = {}'.format(R_0))
-        ## Arenas params
-        β = 0.06 # infectivity of the desease (per contact per day)
-        η = 1/2.34 # η^-1 + α^-1 = 1/5.2 # exposed latent rate
-        ωg = 0.42 # fatality rate of ICU patients
-        ψg = 1/7  # death rate
-        χg = 1/10 # ICU discharge rate
-        σ  = 3.7 # average household size in Mexico (different from Arenas)
-        μg = np.array([1/1,1/3.2,1/3.2]) # escape (from Infected) rate by age group
-        γg = np.array([0.002, 0.05, 0.36]) # fraction of cases requiring ICU by age group
-        kg = np.array([11.8, 13.3, 6.6]) # average contacts per day by age group
-        αg = np.array([1/5.06, 1/2.86, 1/2.86]) # asymptomatic infectious rate by age group
-
-        ## avering out the age groups with the pyramidal distribution of Mexico
-        μ_avg = np.dot(μg, pop_dist_mex)
-        γ_avg = np.dot(γg, pop_dist_mex)
-        k_avg =  np.dot(kg, pop_dist_mex)
-        α = np.dot(αg, pop_dist_mex)
-
-        ## SEAIHRD model params
-        β = -np.exp( -R_0/(k_avg * (1/α + 1/μ_avg) ) ) + 1
-        k_avg
-        η
-        α
-        γI = μ_avg*(1 - γ_avg)
-        μI = 0
-        ν = μ_avg*γ_avg
-        μH = ωg*ψg
-        γH = (1 - ωg)*χg
-
-        ### INITIAL CONDITIONS PER STATE SETUP ###
-        # population per state in Mexico
-        population_per_state_mex = pd.read_csv('./data/poblaciones_estados.csv', index_col=0).sort_index()['population'].values
-        # list of states
-        states_mex = pd.read_csv('./data/poblaciones_estados.csv', index_col=0).sort_index().index.values
-
-        # initial date for the model
-        initial_date = '2020-03-19' # -19 This is the date in which the trend becomes exponential
-
-        # model projection setup
-        tc = 6 # containtment intervention date (days since initial_date)
-        projection_horizon = 60 # 6 days
-        # number of days to run the model for
-        n_days = (datetime.datetime.today() - datetime.datetime.strptime(initial_date, '%Y-%m-%d')).days + projection_horizon
-
-        ### DETERMINING BEST FIT ###
-        # We determine r, the proportion of latent E+A individuals by cross'validations. The functions are very dirty at their current states
-        r_range = np.linspace(0,2.5, 50) # We've seen empirically that they are not very big
-        implementation_date = '2020-03-28' # officialy, it was implemented on the 25th, but we assume it takes at least 3 days to start seeing the effects.
-        data_before_containtment = national_timeseries(mex_confirmed).loc[initial_date:implementation_date, 'México'].values
-        mae_range = cross_validation(data_before_containtment, r_range)
-        # Taking best fit
-        r = r_min(r_range, mae_range)
-        print('r: {}'.format(r))
-
-        ## Preallocation ##
-        # Vectors of solutions. Each vector will contain the results for each state for a specific containtment scenario
-        projections_susana1 = []
-        projections_susana2 = []
-        projections_susana3 = []
-
-        print('Initial date: {}\n'.format(initial_date))
-        for (i,state) in enumerate(states_mex):
-
-            # population for state_i
-            N = population_per_state_mex[i]
-
-            # cases for state_i (from data)
-            confirmed = statal_timeseries(mex_confirmed).loc[initial_date, state]
-            deaths = statal_timeseries(mex_deaths).loc[initial_date, state]
-            recovered = statal_timeseries(mex_recovered).loc[initial_date, state]
-
-            print('{} has a population of {} people'.format(state, N))
-
-            ## initial conditions of state_i setup ##
-            # r = 1 # 0.65 r denotes the fraction of latent cases with respect to the confirmed cases. This is, E0 + A0 = r * I0
-            p = 1/2
-            R0 = recovered / N              # fraction of recovered
-            D0 = deaths / N                 # fraction of deceased
-            I0 = ((confirmed/N) - R0 - D0)  # fraction of confirmed infected cases
-            E0 = p*r * I0                 # fraction of exposed non-infectious cases. Latent variable
-            A0 = (1-p)*r * I0                 # fraction of asymptomatic but infectious cases. Latent variable
-            H0 = 0                          # fraction of hospitalized cases. No data yet
-            CH0 = 0                         # fraction of self-isolated cases. 0 if no prevention is made by the government
-            S0 = (1 - E0 - A0 - I0 - R0 - D0 - H0) # fraction of suceptible cases
-
-            print('with', (I0 + R0 + D0 + H0)*N, 'total cases.' )
-
-            # inital conditions of state_i
-            x0 = np.array([S0, E0, CH0, A0, I0, H0, R0, D0])
-
-            ### MODEL SIMULATIONS FOR VARIOUS CONTAINTMENT SCENARIOS ###
-
-            ## Scenario 1: No action
-            κ0 = 0.0
-            params_1 = (β, k_avg, η, α, γI, μI, ν, γH, μH, κ0, σ, tc)
-
-            ## Scenario 2: Mild distancing
-            κ0 = 0.2
-            params_2 = (β, k_avg, η, α, γI, μI, ν, γH, μH, κ0, σ, tc)
-
-            ## Scenario 3: Strong distancing
-            κ0 = 0.5
-            params_3 = (β, k_avg, η, α, γI, μI, ν, γH, μH, κ0, σ, tc)
-
-            ### run models for state_i ###
-            projection_state_i_scenario_1 = solve(SEAIHRD_markov_step, x0, 0.0, n_days, *params_1) * N
-            projection_state_i_scenario_2 = solve(SEAIHRD_markov_step, x0, 0.0, n_days, *params_2) * N
-            projection_state_i_scenario_3 = solve(SEAIHRD_markov_step, x0, 0.0, n_days, *params_3) * N
-
-            data = statal_timeseries(mex_confirmed).loc[initial_date:,state]
-            projection = TotalCases(projection_state_i_scenario_1)
-            tf_data = data.index.values[-1]
-            print('Projection for {} at {}: {} cases vs {} oficial cases. MAE: ({})'.format( state, tf_data, np.round(projection[-projection_horizon-1]), data.values[-1], round(MAE(data, projection), 1) ))
-
-            # Join model simulation for state_i in the vector of solutions
-            projections_susana1.append( projection_state_i_scenario_1 )
-            projections_susana2.append( projection_state_i_scenario_2 )
-            projections_susana3.append( projection_state_i_scenario_3 )
-
-        ### SAVING RESULTS ###
-        PLOT_PATH = './media/'
-        CSV_PATH  = './results/'
-
-        ## Plot the projections of the model at a national level showing each scenario
-        plt.figure( figsize=(10,8) )
-        mae = plot_cases(CasesAggregation(projections_susana1), mex_confirmed, 'México', initial_date, ls='-', label_proj='$0 \%$ Susana')
-        plot_cases(CasesAggregation(projections_susana2), mex_confirmed, 'México', initial_date, ls='--', label_proj='$20 \%$ Susana')
-        plot_cases(CasesAggregation(projections_susana3), mex_confirmed, 'México', initial_date, ls='-.', label_proj='$50 \%$ Susana', label_data='Casos Totales')
-        plt.axvline([tc], c='black', alpha=0.8)
-        plt.title( 'Casos totales de COVID-19 en {}. (MAE = {}) '.format('México', round(mae,1) ) , size=16)
-        plt.ylabel('Número de infectados', size=15);
-        # plt.yscale('log')
-        plt.tight_layout()
-
-        # here I construct, for every scenario and every value of R0, a CSV with all the corresponding projections
-        scenarios = [projections_susana1, projections_susana2, projections_susana3]
-        df_ = scenarios_to_csv(None, mex_confirmed, scenarios, initial_date, f=TotalCases, R0_index=R0ix)
-        CSV = CSV.join(df_, how='outer')
-
-        save_ = True
-        if save_:
-            today_date = datetime.datetime.today().strftime('%d-%m-%y')
-            plt.savefig( PLOT_PATH+'covid19_mex_proyecciones_{}_R0_{}.png'.format( today_date, str(R_0).replace('.','p')) )
-            # sol_to_csv(CSV_PATH+'covid19_mex_proyeccion_susana_00_{}.csv'.format( today_date ), projections_susana1, initial_date)
-            # sol_to_csv(CSV_PATH+'covid19_mex_proyeccion_susana_20_{}.csv'.format( today_date ), projections_susana2, initial_date)
-            # sol_to_csv(CSV_PATH+'covid19_mex_proyeccion_susana_50_{}.csv'.format( today_date ), projections_susana3, initial_date)
-            print( 'covid19_mex_proyecciones_{}.csv'.format( today_date ) )
+
+    # the values of R_0 are independent, so each one runs in its own process, and the numba threads are split between
+    # them. NUMBA_NUM_THREADS is the size of the numba pool, which follows the cpu affinity of the process
+    n_threads = max(1, numba_config.NUMBA_NUM_THREADS // len(R0s))
+    with ProcessPoolExecutor(max_workers=len(R0s), initializer=init_worker, initargs=(n_threads,)) as executor:
+        results = list( executor.map(partial(run_for_R0, mex_confirmed=mex_confirmed, CONF=CONF, cases_0=cases_0), R0s.items()) )
+
+    # CSV with the results of the model for every R_0
+    CSV = reduce(lambda a, b: a.join(b, how='outer'), results)
 
     if save_:
+        today_date = datetime.datetime.today().strftime('%d-%m-%y')
         Data = national_timeseries(mex_confirmed)
         Data['México'] = Data['México'].astype(int)
         CSV = Data.join(CSV, how='outer')
 
         # str(R_0).replace('.','p')
         CSV.to_csv( CSV_PATH+'covid19_mex_proyeccioneseee_{}.csv'.format( today_date) )
+
+    if DEBUG_SOLVE_ARRAY:
+        # done once the results are saved, and after the workers are forked so the numba threads are not started
+        # in the parent before the fork
+        check_solve_array(initial_conditions(*cases_0, population_per_state_mex, 1.0), projection_horizon,
+                          infectivity(R0s['']), [0.0, 0.2, 0.5], xp=cupy if USE_GPU else np)
+        print('solve_array matches the numba solvers')